@@ -1,3 +1,6 @@
+import copy
+import importlib.util
+import itertools
 import logging
 import os
 import platform
@@ -8,11 +11,13 @@ from datetime import datetime
 from random import randint
 from typing import List, Optional, Union
 
+import numpy as np
 import pytorch_lightning as pl
 import torch
+from packaging import version
 from pkg_resources import resource_filename
 from pytorch_lightning.plugins import DeepSpeedPlugin
-from tqdm.auto import trange
+from tqdm.auto import tqdm
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
@@ -30,8 +35,9 @@ from .colab import create_gdrive_folder
 from .TokenDataset import TokenDataset
 from .train import ATGProgressBar, ATGTransformer
 from .utils import (
+    conv1d_to_linear,
     download_gpt2,
-    find_index_of_subset,
+    find_indices_of_subsets,
     model_max_length,
     reset_seed,
     set_seed,
@@ -42,6 +48,93 @@ logger.setLevel(logging.INFO)
 
 STATIC_PATH = resource_filename(__name__, "static")
 
+# used to normalize schema keys
+_NONALNUM_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+# AdamW(fused=True) requires PyTorch 2.0
+_TORCH_FUSED_ADAMW = version.parse(torch.__version__).release >= (2, 0)
+# torch.load(mmap=True) and load_state_dict(assign=True) require PyTorch 2.1
+_TORCH_MMAP_LOAD = version.parse(torch.__version__).release >= (2, 1)
+_TORCH_COMPILE = _TORCH_MMAP_LOAD
+# the CUDA caching allocator's expandable_segments option requires PyTorch 2.1
+_TORCH_EXPANDABLE_SEGMENTS = _TORCH_MMAP_LOAD
+# torch.onnx.export(dynamo=) was added in PyTorch 2.5
+_TORCH_ONNX_DYNAMO = version.parse(torch.__version__).release >= (2, 5)
+
+# number of available GPUs, checked by to_gpu()
+_CUDA_N = torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+# CUDA caching allocator settings applied by to_gpu()
+_CUDA_ALLOC_CONF = "expandable_segments:True,max_split_size_mb:128"
+
+
+def _with_sdpa(load_fn, *args, **kwargs):
+    """
+    Calls a transformers model constructor (e.g. from_pretrained), requesting
+    the fused scaled_dot_product_attention kernels for the model's attention.
+    Falls back to the default attention if the installed transformers version
+    or the model architecture does not support it.
+    """
+    try:
+        return load_fn(*args, attn_implementation="sdpa", **kwargs)
+    except (TypeError, ValueError):
+        return load_fn(*args, **kwargs)
+
+
+def _load_weights_meta(path: str, config: AutoConfig, device: str = "cpu"):
+    """
+    Constructs the model with its parameters on the meta device, then assigns
+    the weights memory-mapped from the given checkpoint. This avoids both
+    the default weight initialization and a second full copy of the weights.
+
+    safetensors checkpoints are loaded directly onto the given device;
+    pytorch_model.bin checkpoints are always loaded onto the CPU.
+
+    Returns None if this loading strategy is unavailable or the checkpoint
+    does not cover every parameter, in which case load the model normally.
+    """
+    if not _TORCH_MMAP_LOAD:
+        return None
+    try:
+        # Unlike torch.device("meta"), keeps non-persistent buffers
+        # (e.g. the causal attention mask) on the CPU.
+        from accelerate import init_empty_weights
+    except ImportError:
+        return None
+
+    if path.endswith(".safetensors"):
+        try:
+            from safetensors.torch import load_file
+        except ImportError:
+            return None
+        state_dict = load_file(path, device=device)
+    else:
+        state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+    with init_empty_weights():
+        model = _with_sdpa(AutoModelForCausalLM.from_config, config)
+
+    # As from_pretrained() does, load checkpoints of the base model
+    # (e.g. converted from TensorFlow) into the LM head model by adding the
+    # base model's prefix, and load the weights in the default dtype
+    # (assign=True would otherwise keep e.g. FP16 weights as FP16).
+    model_keys = model.state_dict().keys()
+    prefix = model.base_model_prefix + "."
+    dtype = torch.get_default_dtype()
+    state_dict = {
+        (prefix + k if k not in model_keys and prefix + k in model_keys else k): (
+            v.to(dtype) if v.is_floating_point() else v
+        )
+        for k, v in state_dict.items()
+    }
+
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    if any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+        return None
+    return model.eval()
+
 
 class aitextgen:
     """
@@ -58,8 +151,14 @@ class aitextgen:
     This will convert the model to PyTorch if not present.
     :param to_gpu: Whether to load the model into the GPU after loading
     (good for generation)
-    :param to_fp16: Whether to convert the model to FP16 before loading
+    :param to_fp16: Whether to generate with FP16 mixed precision when loading
     to GPU (for supported GPUs only)
+    :param load_in_8bit: Whether to load the model with INT8 weights using
+    bitsandbytes (GPU only). Can only be used with `model` or `model_folder`.
+    :param load_in_4bit: Whether to load the model with 4-bit NF4 weights using
+    bitsandbytes (GPU only). Can only be used with `model` or `model_folder`.
+    :param compile: Whether to compile the model with torch.compile after loading
+    (PyTorch 2.1+). The first generations are slow while the model compiles.
     :param verbose: Whether to enable logging from base Huggingface packages
     :param bos_token: String to override the beginning-of-string token
     :param eos_token: String to override the end-of-string token
@@ -77,6 +176,28 @@ class aitextgen:
     unk_token = "<|endoftext|>"
     pad_token = "<|endoftext|>"
 
+    # mixed precision dtype used for generation, set by to_fp16()/to_bf16()
+    _autocast_dtype = None
+
+    # schema tokens as of their last encoding, and their encodings
+    _schema_tokens = None
+    _schema_tokens_enc = None
+
+    # number of model parameters in millions, cached by __repr__()
+    _num_params_m = None
+
+    # torch.device of the model, set by to_gpu()/to_cpu()
+    _device = None
+
+    # key/value cache allocated by preallocate_kv_cache(), and the
+    # (batch size, max length, device, dtype) it was allocated for
+    _kv_cache = None
+    _kv_cache_spec = None
+
+    # whether to_int8_static() has quantized the model, which can then no
+    # longer be saved, exported or trained
+    _quantized_static = False
+
     def __init__(
         self,
         model: str = None,
@@ -91,6 +212,9 @@ class aitextgen:
         tf_gpt2: str = None,
         to_gpu: bool = False,
         to_fp16: bool = False,
+        load_in_8bit: bool = False,
+        load_in_4bit: bool = False,
+        compile: bool = False,
         verbose: bool = False,
         gradient_checkpointing: bool = False,
         bos_token: str = None,
@@ -116,6 +240,29 @@ class aitextgen:
                 logging.getLogger(module).setLevel(logging.WARN)
             logging.getLogger("transformers.modeling_utils").setLevel(logging.ERROR)
 
+        quantization_kwargs = {}
+        if load_in_8bit or load_in_4bit:
+            assert not (
+                load_in_8bit and load_in_4bit
+            ), "Only one of load_in_8bit and load_in_4bit can be set."
+            # the tf_gpt2 and config branches below construct the model directly
+            assert not tf_gpt2 and (model_folder or not config), (
+                "load_in_8bit and load_in_4bit only apply when loading "
+                + "with `model` or `model_folder`."
+            )
+            from transformers import BitsAndBytesConfig
+
+            # bitsandbytes places the quantized weights on the GPU(s) itself
+            quantization_kwargs = dict(
+                quantization_config=BitsAndBytesConfig(
+                    load_in_8bit=load_in_8bit,
+                    load_in_4bit=load_in_4bit,
+                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_quant_type="nf4",
+                ),
+                device_map="auto",
+            )
+
         if tf_gpt2:
             self.openai_tf_gpt2 = tf_gpt2
 
@@ -163,13 +310,18 @@ class aitextgen:
             model = os.path.join(cache_dir, f"pytorch_model_{tf_gpt2}.bin")
             config = os.path.join(cache_dir, f"config_{tf_gpt2}.json")
 
-            self.model = GPT2LMHeadModel.from_pretrained(model, config=config)
+            self.model = _load_weights_meta(
+                model, GPT2Config.from_json_file(config)
+            ) or _with_sdpa(GPT2LMHeadModel.from_pretrained, model, config=config)
 
         elif model_folder:
-            # A folder is provided containing pytorch_model.bin and config.json
+            # A folder is provided containing the weights and config.json
+            weights_path = os.path.join(model_folder, "model.safetensors")
+            if not os.path.exists(weights_path):
+                weights_path = os.path.join(model_folder, "pytorch_model.bin")
             assert os.path.exists(
-                os.path.join(model_folder, "pytorch_model.bin")
-            ), f"There is no pytorch_model.bin in /{model_folder}."
+                weights_path
+            ), f"There is no model.safetensors or pytorch_model.bin in /{model_folder}."
             assert os.path.exists(
                 os.path.join(model_folder, "config.json")
             ), f"There is no config.json in /{model_folder}."
@@ -177,23 +329,41 @@ class aitextgen:
             logger.info(
                 f"Loading model from provided weights and config in /{model_folder}."
             )
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_folder, local_files_only=True
+            # safetensors weights can be copied straight into GPU memory
+            load_device = "cuda:0" if to_gpu and _CUDA_N > 0 else "cpu"
+            self.model = (
+                _load_weights_meta(
+                    weights_path,
+                    AutoConfig.from_pretrained(model_folder, local_files_only=True),
+                    device=load_device,
+                )
+                if not quantization_kwargs
+                else None
+            ) or _with_sdpa(
+                AutoModelForCausalLM.from_pretrained,
+                model_folder,
+                local_files_only=True,
+                # avoids initializing the weights before loading them
+                low_cpu_mem_usage=importlib.util.find_spec("accelerate") is not None,
+                **quantization_kwargs,
             )
         elif config:
             # Manually construct a model from scratch
             logger.info("Constructing model from provided config.")
             if isinstance(config, str):
                 config = AutoConfig.from_pretrained(config)
-            self.model = AutoModelForCausalLM.from_config(config=config)
+            self.model = _with_sdpa(AutoModelForCausalLM.from_config, config=config)
         else:
             # Download and cache model from Huggingface
             if os.path.isdir(cache_dir) and len(os.listdir(cache_dir)) > 0:
                 logger.info(f"Loading {model or 'gpt2'} model from /{cache_dir}.")
             else:
                 logger.info(f"Downloading {model or 'gpt2'} model to /{cache_dir}.")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model or "gpt2", cache_dir=cache_dir
+            self.model = _with_sdpa(
+                AutoModelForCausalLM.from_pretrained,
+                model or "gpt2",
+                cache_dir=cache_dir,
+                **quantization_kwargs,
             )
             if model and "gpt2" not in model:
                 logger.info(f"Using the tokenizer for {model}.")
@@ -264,15 +434,28 @@ class aitextgen:
 
         self.tokenizer.padding_side = "left"
 
-        if to_gpu:
+        # cached for generation, as neither changes after loading
+        self._max_length = model_max_length(self.model.config)
+        self._pad_token_id = getattr(self.tokenizer, "pad_token_id", None) or getattr(
+            self.tokenizer, "eos_token_id", None
+        )
+
+        if getattr(self.model.config, "schema_tokens", None):
+            self._get_schema_tokens_enc()
+
+        # The model is only put in training mode while training
+        self.model = self.model.eval()
+
+        if quantization_kwargs:
+            logger.info("Model weights are quantized and already placed on the GPU.")
+        elif to_gpu:
             if to_fp16:
-                logger.warn(
-                    "Currently, FP16 text generation results in random output. "
-                    + "You may want to avoid using to_fp16 for the time being."
-                )
                 self.to_fp16()
             self.to_gpu()
 
+        if compile:
+            self._compile_model()
+
     def generate(
         self,
         n: int = 1,
@@ -291,6 +474,7 @@ class aitextgen:
         lstrip: bool = True,
         nonempty_output: bool = True,
         skip_special_tokens: bool = True,
+        max_retries: int = 5,
         **kwargs,
     ) -> Optional[str]:
         """
@@ -310,97 +494,177 @@ class aitextgen:
         :param seed: A numeric seed which sets all randomness, allowing the
         generate text to be reproducible if rerunning with same parameters
         and model.
+        :param max_retries: Maximum number of times to generate again if no
+        texts are left after applying nonempty_output/min_length. If exceeded,
+        the texts are returned without that filtering.
+        """
+
+        input_ids = self._encode_prompt(prompt, prepend_bos)
+
+        return self._generate_with_ids(
+            input_ids,
+            n=n,
+            prompt=prompt,
+            min_length=min_length,
+            max_length=max_length,
+            temperature=temperature,
+            do_sample=do_sample,
+            return_as_list=return_as_list,
+            seed=seed,
+            pad_token_id=pad_token_id,
+            schema=schema,
+            normalize_key=normalize_key,
+            use_cache=use_cache,
+            lstrip=lstrip,
+            nonempty_output=nonempty_output,
+            skip_special_tokens=skip_special_tokens,
+            max_retries=max_retries,
+            **kwargs,
+        )
+
+    def _encode_prompt(
+        self, prompt: str = "", prepend_bos: bool = None, pin_memory: bool = False
+    ) -> Optional[torch.Tensor]:
         """
+        Tokenizes the prompt (plus the bos token if needed) into the input_ids
+        for generation, on the model's device. Returns None if there is no input.
 
-        prompt_text = prompt
-        prompt_tensors = self.tokenizer(text=prompt, return_tensors="pt")
+        :param pin_memory: Whether to copy the input_ids to the GPU from pinned
+        memory; only worthwhile if the input_ids are reused.
+        """
 
+        input_ids = None
         if prompt:
-            prompt_num_tokens = list(prompt_tensors["input_ids"].shape)[1]
-            assert prompt_num_tokens < model_max_length(
-                self.model.config
+            input_ids = self.tokenizer(text=prompt, return_tensors="pt")["input_ids"]
+            prompt_num_tokens = list(input_ids.shape)[1]
+            assert (
+                prompt_num_tokens < self._max_length
             ), f"The prompt is too large for the model. ({prompt_num_tokens} tokens)"
 
-        input_ids = (
-            prompt_tensors["input_ids"].to(self.get_device()) if prompt else None
-        )
-
         if prepend_bos is None:
             prepend_bos = getattr(self.model.config, "line_by_line", None)
 
         if prepend_bos:
-            bos = torch.tensor([[self.tokenizer.bos_token_id]]).to(self.get_device())
+            bos = torch.tensor([[self.tokenizer.bos_token_id]])
             if prompt:
                 input_ids = torch.cat((bos, input_ids), dim=1)
             else:
                 input_ids = bos
 
+        if input_ids is None:
+            return None
+
+        device = self._device or self.model.device
+        if pin_memory and device.type == "cuda":
+            return input_ids.pin_memory().to(device, non_blocking=True)
+        return input_ids.to(device)
+
+    @torch.inference_mode()
+    def _generate_with_ids(
+        self,
+        input_ids: Optional[torch.Tensor],
+        n: int = 1,
+        prompt: str = "",
+        min_length: int = None,
+        max_length: int = 256,
+        temperature: float = 0.7,
+        do_sample: bool = True,
+        return_as_list: bool = False,
+        seed: int = None,
+        pad_token_id: str = None,
+        schema: str = False,
+        normalize_key: bool = True,
+        use_cache: bool = True,
+        lstrip: bool = True,
+        nonempty_output: bool = True,
+        skip_special_tokens: bool = True,
+        max_retries: int = 5,
+        **kwargs,
+    ) -> Optional[str]:
+        """
+        Generates texts from already-tokenized input_ids (see _encode_prompt()).
+        The prompt is only used to bold it when printing to console.
+
+        See generate() for the parameters.
+        """
+
         if seed:
             set_seed(seed)
 
         if pad_token_id is None:
-            pad_token_id = getattr(self.tokenizer, "pad_token_id", None) or getattr(
-                self.tokenizer, "eos_token_id", None
-            )
+            pad_token_id = self._pad_token_id
 
         # prevent an error from using a length greater than the model
-        gen_max_length = model_max_length(self.model.config)
-        max_length = min(gen_max_length, max_length)
+        max_length = min(self._max_length, max_length)
 
+        num_retries = 0
         while True:
-            outputs = self.model.generate(
-                input_ids=input_ids,
-                min_length=min_length,
-                max_length=max_length,
-                temperature=temperature,
-                do_sample=do_sample,
-                num_return_sequences=n,
-                pad_token_id=pad_token_id,
-                use_cache=use_cache,
-                **kwargs,
-            )
+            kv_cache = self._get_kv_cache(n, max_length)
+            if kv_cache is not None:
+                kwargs["past_key_values"] = kv_cache
+
+            with self._autocast():
+                outputs = self.model.generate(
+                    input_ids=input_ids,
+                    min_length=min_length,
+                    max_length=max_length,
+                    temperature=temperature,
+                    do_sample=do_sample,
+                    num_return_sequences=n,
+                    pad_token_id=pad_token_id,
+                    use_cache=use_cache,
+                    **kwargs,
+                )
 
             # Schema token handling
             if schema:
                 schema_tokens = getattr(self.model.config, "schema_tokens")
                 schema_return = getattr(self.model.config, "schema_return", None)
-                schema_tokens_enc = self.tokenizer(text=schema_tokens)["input_ids"]
+                schema_tokens_enc = self._get_schema_tokens_enc()
 
-                nonalphanum_pattern = re.compile(r"[\W_]+", re.UNICODE)
+                # Get indices of each schema token within each text
+                schema_indices = find_indices_of_subsets(outputs, schema_tokens_enc)
 
                 outputs = outputs.tolist()
-                gen_texts = []
-                for output in outputs:
+                gen_text_dicts = []
+                # token slices to decode, and the (dict, key) each belongs to
+                schema_slices = []
+                schema_slice_keys = []
+                for output, token_indices in zip(outputs, schema_indices):
                     gen_text_dict = {}
-
-                    # Get indices of each schema token within the text
-                    schema_token_indices = [
-                        (schema_tokens[i], find_index_of_subset(output, token_enc))
-                        for i, token_enc in enumerate(schema_tokens_enc)
-                    ]
+                    schema_token_indices = list(zip(schema_tokens, token_indices))
 
                     schema_token_indices.sort(key=lambda x: x[1])
 
                     for i, token_tuple in enumerate(schema_token_indices):
                         start_index = token_tuple[1]
                         key = (
-                            nonalphanum_pattern.sub("", token_tuple[0])
+                            _NONALNUM_RE.sub("", token_tuple[0])
                             if normalize_key
                             else token_tuple[0]
                         )
-                        if start_index == -1:
-                            gen_text_dict[key] = ""
-                        else:
+                        gen_text_dict[key] = ""
+                        if start_index != -1:
                             end_index = (
                                 schema_token_indices[i + 1][1] - 1
                                 if i + 1 < len(schema_token_indices)
                                 else None
                             )
 
-                            gen_text_dict[key] = self.tokenizer.decode(
-                                output[start_index:end_index], skip_special_tokens=True
-                            )
+                            schema_slices.append(output[start_index:end_index])
+                            schema_slice_keys.append((gen_text_dict, key))
 
+                    gen_text_dicts.append(gen_text_dict)
+
+                # Decode the fields of all outputs at once
+                decoded_texts = self.tokenizer.batch_decode(
+                    schema_slices, skip_special_tokens=True
+                )
+                for (gen_text_dict, key), text in zip(schema_slice_keys, decoded_texts):
+                    gen_text_dict[key] = text
+
+                gen_texts = []
+                for gen_text_dict in gen_text_dicts:
                     # remove fields not in schema_return
                     if schema_return:
                         keys = gen_text_dict.keys()
@@ -425,27 +689,69 @@ class aitextgen:
                     else:
                         return gen_texts[0]
 
+            # Single text: decode it directly, skipping the list handling below
+            elif n == 1:
+                text = self.tokenizer.decode(
+                    outputs[0], skip_special_tokens=skip_special_tokens
+                )
+                if lstrip:
+                    text = text.lstrip()
+
+                # if there is no generated text after cleanup, try again.
+                if nonempty_output and len(text) <= (min_length or 0):
+                    if num_retries < max_retries:
+                        num_retries += 1
+                        continue
+
+                    logger.warning(
+                        f"No generated text was kept after {max_retries} retries;"
+                        + " returning it without the length filter."
+                    )
+
+                # Reset seed if used
+                if seed:
+                    reset_seed()
+
+                if not return_as_list:
+                    # Bold the prompt if printing to console
+                    print(
+                        text.replace(prompt, f"\033[1m{prompt}\033[0m", 1)
+                        if prompt
+                        else text
+                    )
+                    break
+                else:
+                    return [text]
+
             # Typical use case
             else:
-                gen_texts = self.tokenizer.batch_decode(
+                decoded_texts = self.tokenizer.batch_decode(
                     outputs, skip_special_tokens=skip_special_tokens
                 )
 
-                # Handle stripping tokenization spaces w/ regex
-                if lstrip:
-                    gen_texts = [re.sub(r"^\s+", "", text) for text in gen_texts]
-
-                if nonempty_output:
-                    if min_length:
-                        gen_texts = list(
-                            filter(lambda x: len(x) > min_length, gen_texts)
-                        )
-                    else:
-                        gen_texts = list(filter(lambda x: len(x) > 0, gen_texts))
+                # Strip tokenization spaces and drop empty/short texts in one pass
+                min_text_length = (min_length or 0) if nonempty_output else -1
+                gen_texts = [
+                    text
+                    for text in (
+                        (text.lstrip() if lstrip else text) for text in decoded_texts
+                    )
+                    if len(text) > min_text_length
+                ]
 
                 # if there is no generated text after cleanup, try again.
                 if len(gen_texts) == 0:
-                    continue
+                    if num_retries < max_retries:
+                        num_retries += 1
+                        continue
+
+                    logger.warning(
+                        f"No generated texts were kept after {max_retries} retries;"
+                        + " returning them without the length filter."
+                    )
+                    gen_texts = [
+                        text.lstrip() if lstrip else text for text in decoded_texts
+                    ]
 
                 # Reset seed if used
                 if seed:
@@ -455,7 +761,7 @@ class aitextgen:
                     if prompt:
                         # Bold the prompt if printing to console
                         gen_texts = [
-                            text.replace(prompt_text, f"\033[1m{prompt_text}\033[0m", 1)
+                            text.replace(prompt, f"\033[1m{prompt}\033[0m", 1)
                             for text in gen_texts
                         ]
 
@@ -467,6 +773,17 @@ class aitextgen:
                 else:
                     return gen_texts
 
+    def _get_schema_tokens_enc(self) -> List[List[int]]:
+        """
+        Returns the tokenized schema_tokens of the model config,
+        only retokenizing them if they have changed since the last call.
+        """
+        schema_tokens = getattr(self.model.config, "schema_tokens")
+        if schema_tokens != self._schema_tokens:
+            self._schema_tokens = list(schema_tokens)
+            self._schema_tokens_enc = self.tokenizer(text=schema_tokens)["input_ids"]
+        return self._schema_tokens_enc
+
     def generate_one(self, **kwargs) -> None:
         """
         Generates a single text, and returns it as a string. Useful for
@@ -477,6 +794,82 @@ class aitextgen:
 
         return self.generate(n=1, return_as_list=True, **kwargs)[0]
 
+    @torch.inference_mode()
+    def generate_batch(
+        self,
+        prompts: List[str],
+        batch_size: int = 8,
+        max_length: int = 256,
+        temperature: float = 0.7,
+        do_sample: bool = True,
+        skip_special_tokens: bool = True,
+        seed: int = None,
+        prepend_bos: bool = None,
+        **kwargs,
+    ) -> List[str]:
+        """
+        Generates a text for each of the given prompts, padding batch_size
+        prompts at a time into a single call to the model's generate(), and
+        returns the texts (including their prompts) as a list in the same order.
+
+        :param prompts: List of prompts to generate texts from
+        :param batch_size: Number of prompts to generate from simultaneously,
+        taking advantage of CPU/GPU parallelization.
+
+        See generate() for more parameters.
+        """
+
+        assert all(prompts), "Each prompt must be nonempty."
+
+        if seed:
+            set_seed(seed)
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        if prepend_bos is None:
+            prepend_bos = getattr(self.model.config, "line_by_line", None)
+
+        if prepend_bos:
+            prompts = [self.tokenizer.bos_token + prompt for prompt in prompts]
+
+        # prevent an error from using a length greater than the model
+        max_length = min(self._max_length, max_length)
+        device = self._device or self.model.device
+
+        gen_texts = []
+        for i in range(0, len(prompts), batch_size):
+            # prompts are left-padded, so generation continues from each one
+            inputs = self.tokenizer(
+                prompts[i : i + batch_size], padding=True, return_tensors="pt"
+            ).to(device)
+            # the last batch may be smaller, so only pass a cache that fits it
+            batch_kwargs = dict(kwargs)
+            kv_cache = self._get_kv_cache(len(inputs["input_ids"]), max_length)
+            if kv_cache is not None:
+                batch_kwargs["past_key_values"] = kv_cache
+
+            with self._autocast():
+                outputs = self.model.generate(
+                    input_ids=inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    max_length=max_length,
+                    temperature=temperature,
+                    do_sample=do_sample,
+                    pad_token_id=self._pad_token_id,
+                    **batch_kwargs,
+                )
+            gen_texts.extend(
+                self.tokenizer.batch_decode(
+                    outputs, skip_special_tokens=skip_special_tokens
+                )
+            )
+
+        if seed:
+            reset_seed()
+
+        return gen_texts
+
     def generate_samples(
         self, n: int = 3, temperatures: List[float] = [0.7, 1.0, 1.2], **kwargs
     ) -> None:
@@ -516,8 +909,6 @@ class aitextgen:
 
         assert n % batch_size == 0, f"n must be divisible by batch_size ({batch_size})."
 
-        self.model = self.model.eval()
-
         if destination_path is None:
             # Create a time-based file name to prevent overwriting.
             # Use a 8-digit number as the seed, which is the last
@@ -532,18 +923,35 @@ class aitextgen:
 
         logger.info(f"Generating {n:,} texts to {destination_path}")
 
-        pbar = trange(n)
-        f = open(destination_path, "w", encoding="utf-8")
+        # The prompt is the same for every batch, so only tokenize it once
+        prompt = kwargs.pop("prompt", "")
+        input_ids = self._encode_prompt(
+            prompt, kwargs.pop("prepend_bos", None), pin_memory=True
+        )
 
-        for _ in range(n // batch_size):
-            gen_texts = self.generate(n=batch_size, return_as_list=True, **kwargs)
+        pbar = tqdm(total=n)
+        sample_delim_b = sample_delim.encode("utf-8")
+
+        # Write each batch with one call into a large buffer to minimize syscalls
+        with open(destination_path, "wb", buffering=1 << 20) as f:
+            for _ in range(n // batch_size):
+                gen_texts = self._generate_with_ids(
+                    input_ids,
+                    n=batch_size,
+                    prompt=prompt,
+                    return_as_list=True,
+                    **kwargs,
+                )
 
-            for gen_text in gen_texts:
-                f.write("{}\n{}".format(gen_text, sample_delim))
-            pbar.update(batch_size)
+                f.write(
+                    b"".join(
+                        f"{gen_text}\n".encode("utf-8") + sample_delim_b
+                        for gen_text in gen_texts
+                    )
+                )
+                pbar.update(batch_size)
 
         pbar.close()
-        f.close()
 
         if seed:
             reset_seed()
@@ -578,6 +986,7 @@ class aitextgen:
         freeze_layers: bool = False,
         num_layers_freeze: int = None,
         use_deepspeed: bool = False,
+        optimizer: str = "adamw",
         **kwargs,
     ) -> None:
         """
@@ -587,7 +996,10 @@ class aitextgen:
         a string containing the text to be trained (shortcut instead of dataset)
         :param output_dir: A string indicating where to store the resulting
         model file folder.
-        :param fp16: Boolean whether to use fp16, assuming using a compatible GPU/TPU.
+        :param fp16: Boolean whether to use mixed precision, assuming using a
+        compatible GPU. BF16 is used on GPUs which support it (Ampere or newer),
+        which roughly doubles training throughput over FP32 without the loss
+        instability of FP16.
         :param fp16_opt_level: Option level for FP16/APEX training.
         :param n_gpu: Number of GPU to use (-1 implies all available GPUs)
         :param tpu_cores: Number of TPU cores to use (should be a multiple of 8)
@@ -611,8 +1023,23 @@ class aitextgen:
         :param run_id: Run identifier; used for save_gdrive
         :param progress_bar_refresh_rate: How often to update
         the progress bar while training.
+        :param optimizer: The AdamW variant to train with: "adamw" (default),
+        "adamw_fused" (a fused CUDA kernel per step; GPU only), or "adamw_8bit"
+        (8-bit optimizer states via bitsandbytes, for large models).
         """
 
+        assert optimizer in [
+            "adamw",
+            "adamw_fused",
+            "adamw_8bit",
+        ], "optimizer must be one of adamw, adamw_fused, or adamw_8bit."
+        assert (
+            optimizer != "adamw_fused" or _TORCH_FUSED_ADAMW
+        ), "The adamw_fused optimizer requires PyTorch 2.0 or later."
+        assert (
+            not self._quantized_static
+        ), "Models quantized with to_int8_static() cannot be trained."
+
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
@@ -626,7 +1053,7 @@ class aitextgen:
         is_gpu_used = torch.cuda.is_available() and n_gpu != 0
 
         if isinstance(train_data, str):
-            block_size = model_max_length(self.model.config)
+            block_size = self._max_length
             logger.info(
                 f"Loading text from {train_data} with generation length of {block_size}."
             )
@@ -667,9 +1094,12 @@ class aitextgen:
             num_steps=num_steps,
             pin_memory=is_gpu_used,
             num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4,
             save_every=save_every,
             generate_every=generate_every,
             use_tpu=tpu_cores > 0,
+            optimizer=optimizer,
         )
 
         # Wrap the model in a pytorch-lightning module
@@ -679,9 +1109,9 @@ class aitextgen:
         if seed:
             set_seed(seed)
 
-        if os.path.exists(output_dir) and "pytorch_model.bin" in os.listdir(output_dir):
+        if os.path.exists(output_dir) and "model.safetensors" in os.listdir(output_dir):
             logger.warning(
-                f"pytorch_model.bin already exists in /{output_dir} and will be overwritten!"
+                f"model.safetensors already exists in /{output_dir} and will be overwritten!"
             )
 
         # if try to use a GPU but no CUDA, use CPU
@@ -736,22 +1166,23 @@ class aitextgen:
             plugins=deepspeed_plugin,
         )
 
-        print("753")
-        print(train_params)
-        train_params["precision"] = 16
-        train_params["amp_level"] = None
-        train_params["amp_backend"] = "native"
-        print(train_params)
-        print("xxx")
+        if fp16 and is_gpu_used:
+            train_params["precision"] = (
+                "bf16" if torch.cuda.is_bf16_supported() and not use_deepspeed else 16
+            )
+
         trainer = pl.Trainer(**train_params)
         trainer.fit(train_model)
+        self.model = self.model.eval()
+        # training may have moved the model between devices
+        self._device = None
 
-        logger.info(f"Saving trained model pytorch_model.bin to /{output_dir}")
+        logger.info(f"Saving trained model model.safetensors to /{output_dir}")
 
-        self.model.save_pretrained(output_dir)
+        self.model.save_pretrained(output_dir, safe_serialization=True)
 
         if save_gdrive:
-            for pt_file in ["pytorch_model.bin", "config.json"]:
+            for pt_file in ["model.safetensors", "config.json"]:
                 shutil.copyfile(
                     os.path.join(output_dir, pt_file),
                     os.path.join("/content/drive/My Drive/", run_id, pt_file),
@@ -786,11 +1217,14 @@ class aitextgen:
             for x in inputs
         ]
 
+        # halve the learning rate and number of steps after each dataset
+        scales = np.ldexp(1.0, -np.arange(len(datasets)))
+
         if not isinstance(learning_rate, list):
-            learning_rate = [learning_rate / (2 ** x) for x in range(len(datasets))]
+            learning_rate = (learning_rate * scales).tolist()
 
         if not isinstance(num_steps, list):
-            num_steps = [int(num_steps / (2 ** x)) for x in range(len(datasets))]
+            num_steps = (num_steps * scales).astype(np.int64).tolist()
 
         assert len(datasets) == len(learning_rate) == len(num_steps), (
             "The provided learning_rates or num_steps"
@@ -807,9 +1241,17 @@ class aitextgen:
                 **kwargs,
             )
 
-    def save(self, target_folder: str = os.getcwd()):
-        """Saves the model into the specified directory."""
-        self.model.save_pretrained(target_folder)
+    def save(self, target_folder: Optional[str] = None):
+        """
+        Saves the model into the specified directory
+        (defaults to the current working directory).
+        """
+        assert (
+            not self._quantized_static
+        ), "Models quantized with to_int8_static() cannot be saved."
+        self.model.save_pretrained(
+            target_folder or os.getcwd(), safe_serialization=True
+        )
 
     def save_for_upload(self, target_folder: str = "my-model"):
         """
@@ -818,43 +1260,472 @@ class aitextgen:
         This generates the 6 files needed to upload the model to
         Huggingface's S3 bucket.
         """
-        self.model.save_pretrained(target_folder)
+        assert (
+            not self._quantized_static
+        ), "Models quantized with to_int8_static() cannot be saved."
+        self.model.save_pretrained(target_folder, safe_serialization=True)
         self.tokenizer.save_pretrained(target_folder)
 
     def export(
         self,
         quantize: bool = True,
+        target_folder: str = "exported_model",
+        backend: str = "fbgemm",
     ) -> None:
         """
-        Exports the model, with optional quantization
+        Exports the model as TorchScript for CPU inference, with optional INT8
+        dynamic quantization of its Linear layers, alongside the tokenizer.
+
+        The exported model.pt can be loaded with torch.jit.load(); it takes
+        a tensor of input_ids and returns a tuple containing the logits.
+
+        :param quantize: Whether to quantize the Linear layers to INT8
+        :param target_folder: Folder to save the exported model and tokenizer
+        :param backend: Quantization engine: "fbgemm" for x86, "qnnpack" for ARM
         """
 
-    def to_gpu(self, index: int = 0) -> None:
-        """Moves the model to the specified GPU."""
+        model = self._copy_for_export()
 
+        if quantize:
+            torch.backends.quantized.engine = backend
+            # GPT-2's attention and MLP layers are Conv1D, which is not quantizable
+            conv1d_to_linear(model)
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+
+        example_input_ids = torch.tensor([[self.tokenizer.eos_token_id] * 8])
+        traced_model = torch.jit.trace(model, example_input_ids)
+
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        torch.jit.save(traced_model, os.path.join(target_folder, "model.pt"))
+        self.tokenizer.save_pretrained(target_folder)
+
+    def save_onnx(
+        self,
+        target_folder: str = "onnx_model",
+        opset: int = 17,
+        quantize_int8: bool = True,
+    ) -> None:
+        """
+        Exports the model to ONNX as model.onnx for inference with ONNX Runtime,
+        alongside the tokenizer. The exported model takes a tensor of input_ids
+        (with dynamic batch and sequence lengths) and returns the logits.
+
+        :param target_folder: Folder to save the exported model and tokenizer
+        :param opset: The ONNX opset version to export with
+        :param quantize_int8: Whether to also save a model.int8.onnx with its
+        weights quantized to INT8 (requires onnxruntime)
+        """
+
+        model = self._copy_for_export()
+        example_input_ids = torch.tensor([[self.tokenizer.eos_token_id] * 8])
+
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        onnx_path = os.path.join(target_folder, "model.onnx")
+
+        dynamic_axes = {"input_ids": {0: "batch", 1: "seq"}}
+        dynamic_axes["logits"] = dynamic_axes["input_ids"]
+        # export with the tracing-based exporter on all PyTorch versions
+        export_kwargs = {"dynamo": False} if _TORCH_ONNX_DYNAMO else {}
+        torch.onnx.export(
+            model,
+            (example_input_ids,),
+            onnx_path,
+            input_names=["input_ids"],
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            **export_kwargs,
+        )
+
+        if quantize_int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(
+                onnx_path,
+                os.path.join(target_folder, "model.int8.onnx"),
+                weight_type=QuantType.QInt8,
+            )
+
+        self.tokenizer.save_pretrained(target_folder)
+
+    def export_tensorrt(
+        self,
+        target_folder: str = "tensorrt_model",
+        precision: str = "fp16",
+        calibration_texts: List[str] = None,
+        max_batch_size: int = 8,
+    ) -> None:
+        """
+        Builds a TensorRT engine from the model for inference on NVIDIA GPUs,
+        saved as model.engine alongside the ONNX model it is built from
+        (see save_onnx()) and the tokenizer. Requires tensorrt.
+
+        The engine takes a tensor of input_ids, with up to max_batch_size rows
+        and up to the model's maximum length columns, and returns the logits.
+
+        :param target_folder: Folder to save the engine, ONNX model and tokenizer
+        :param precision: "fp16", or "int8" to also run layers in INT8 where
+        TensorRT finds it faster, calibrated on calibration_texts
+        :param calibration_texts: Texts representative of the inputs,
+        required for INT8
+        :param max_batch_size: The largest batch size the engine will accept
+        """
+
+        assert precision in ["fp16", "int8"], "precision must be fp16 or int8."
+        assert (
+            precision == "fp16" or calibration_texts
+        ), "calibration_texts are required for INT8 precision."
         assert torch.cuda.is_available(), "CUDA is not installed."
 
-        self.model.to(torch.device("cuda", index))
+        import tensorrt as trt
+
+        self.save_onnx(target_folder, quantize_int8=False)
+
+        trt_logger = trt.Logger(trt.Logger.WARNING)
+        builder = trt.Builder(trt_logger)
+        network = builder.create_network(
+            1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+        )
+        parser = trt.OnnxParser(network, trt_logger)
+        # parse from the path, so the weights of models over 2 GB, which are
+        # exported to external data files alongside it, are found
+        parsed = parser.parse_from_file(os.path.join(target_folder, "model.onnx"))
+        errors = [parser.get_error(i).desc() for i in range(parser.num_errors)]
+        assert parsed, "TensorRT failed to parse the ONNX model:\n" + "\n".join(errors)
+
+        config = builder.create_builder_config()
+        profile = builder.create_optimization_profile()
+        max_shape = (max_batch_size, self._max_length)
+        profile.set_shape("input_ids", (1, 1), max_shape, max_shape)
+        config.add_optimization_profile(profile)
+        config.set_flag(trt.BuilderFlag.FP16)
+
+        if precision == "int8":
+
+            class _Calibrator(trt.IInt8EntropyCalibrator2):
+                """Feeds the calibration batches to TensorRT from the GPU."""
+
+                def __init__(self, batches):
+                    super().__init__()
+                    self.batches = iter(batches)
+                    self.batch = None
+
+                def get_batch_size(self):
+                    return 1
+
+                def get_batch(self, names):
+                    # keep a reference to the batch while TensorRT reads it
+                    self.batch = next(self.batches, None)
+                    return None if self.batch is None else [self.batch.data_ptr()]
+
+                def read_calibration_cache(self):
+                    return None
+
+                def write_calibration_cache(self, cache):
+                    pass
+
+            # TensorRT calibrates using a single input shape, so right-pad
+            # the texts to the same length
+            encoded = [
+                input_ids[: self._max_length]
+                for input_ids in self.tokenizer(calibration_texts)["input_ids"]
+            ]
+            calibration_length = max(len(input_ids) for input_ids in encoded)
+            input_dtype = (
+                torch.int32 if network.get_input(0).dtype == trt.int32 else torch.int64
+            )
+            batches = [
+                torch.tensor(
+                    [
+                        input_ids
+                        + [self._pad_token_id] * (calibration_length - len(input_ids))
+                    ],
+                    dtype=input_dtype,
+                    device="cuda",
+                )
+                for input_ids in encoded
+            ]
+
+            calibration_profile = builder.create_optimization_profile()
+            calibration_shape = (1, calibration_length)
+            calibration_profile.set_shape(
+                "input_ids", calibration_shape, calibration_shape, calibration_shape
+            )
+            config.set_flag(trt.BuilderFlag.INT8)
+            config.int8_calibrator = _Calibrator(batches)
+            config.set_calibration_profile(calibration_profile)
+
+        serialized_engine = builder.build_serialized_network(network, config)
+        assert serialized_engine is not None, "TensorRT failed to build the engine."
+        with open(os.path.join(target_folder, "model.engine"), "wb") as f:
+            f.write(serialized_engine)
 
-    def to_cpu(self, index: int = 0) -> None:
-        """Moves the model to the specified CPU."""
+    def _copy_for_export(self) -> torch.nn.Module:
+        """
+        Returns a CPU copy of the model in eval mode, configured to take only
+        input_ids and return a (logits,) tuple, as needed for tracing.
+        """
+
+        assert (
+            not self._quantized_static
+        ), "Models quantized with to_int8_static() cannot be exported."
+
+        # copy the model without its compiled forward (see _compile_model()),
+        # which cannot be traced and would still call the original model
+        compiled_forward = self.model.__dict__.pop("forward", None)
+        try:
+            model = copy.deepcopy(self.model)
+        finally:
+            if compiled_forward is not None:
+                self.model.forward = compiled_forward
+
+        model = model.to("cpu").eval()
+        model.config.return_dict = False
+        model.config.use_cache = False
+        return model
+
+    def to_gpu(
+        self, index: int = 0, compile: bool = False, mode: str = "reduce-overhead"
+    ) -> None:
+        """
+        Moves the model to the specified GPU.
+
+        :param compile: Whether to then compile the model with torch.compile
+        (PyTorch 2.1+). The first generations are slow while the model compiles.
+        :param mode: The torch.compile mode to use if compiling.
+        """
+
+        assert _CUDA_N > 0, "CUDA is not installed."
+        assert _CUDA_N > index, f"There is no GPU with index {index}."
+
+        # Reduce fragmentation of the CUDA caching allocator as the generation
+        # cache grows, unless the user has configured it themselves.
+        if (
+            _TORCH_EXPANDABLE_SEGMENTS
+            and not os.environ.get("PYTORCH_CUDA_ALLOC_CONF")
+            and hasattr(torch.cuda.memory, "_set_allocator_settings")
+        ):
+            torch.cuda.memory._set_allocator_settings(_CUDA_ALLOC_CONF)
+
+        device = torch.device("cuda", index)
+        torch.cuda.set_device(device)
+        # queue the copies of all parameters, then wait for them once
+        self.model = self.model.to(device=device, non_blocking=True)
+        torch.cuda.synchronize(device)
+        self._device = device
+
+        if compile:
+            self._compile_model(mode)
+
+    def preallocate_kv_cache(
+        self, max_length: Optional[int] = None, batch_size: int = 1
+    ) -> None:
+        """
+        Allocates the key/value cache used in generation up front, sized for
+        batch_size texts of up to max_length tokens, so it is not reallocated
+        as the generated texts grow. Generations with exactly batch_size texts
+        (i.e. n or batch_size) and at most max_length tokens then reuse it.
+
+        Only models which support a static cache in transformers can use one.
+        Call after to_gpu()/to_cpu() and to_fp16()/to_bf16().
+
+        :param max_length: The maximum length of the generated texts
+        (defaults to the model's maximum)
+        :param batch_size: The number of texts generated at once
+        """
 
-        self.model.to(torch.device("cpu", index))
+        if not getattr(self.model, "_supports_static_cache", False):
+            logger.warning(
+                f"{type(self.model).__name__} does not support a preallocated cache."
+            )
+            return
+
+        from transformers import StaticCache
+
+        max_length = min(max_length or self._max_length, self._max_length)
+        device = self._device or self.model.device
+        dtype = self._autocast_dtype or self.model.dtype
+        self._kv_cache = StaticCache(
+            config=self.model.config,
+            max_batch_size=batch_size,
+            max_cache_len=max_length,
+            device=device,
+            dtype=dtype,
+        )
+        self._kv_cache_spec = (batch_size, max_length, device, dtype)
+
+    def _get_kv_cache(self, batch_size: int, max_length: int):
+        """
+        Returns the cache allocated by preallocate_kv_cache(), emptied for a
+        new generation, or None if there is none matching the generation.
+        """
+
+        if self._kv_cache is None:
+            return None
+
+        cache_batch_size, cache_max_length, device, dtype = self._kv_cache_spec
+        if (
+            batch_size != cache_batch_size
+            or max_length > cache_max_length
+            or device != (self._device or self.model.device)
+            or dtype != (self._autocast_dtype or self.model.dtype)
+        ):
+            return None
+
+        self._kv_cache.reset()
+        return self._kv_cache
+
+    def to_cpu(self, index: int = 0, use_ipex: bool = True) -> None:
+        """
+        Moves the model to the specified CPU.
+
+        :param use_ipex: Whether to then optimize the model for Intel CPUs
+        with intel_extension_for_pytorch, if it is installed.
+        """
+
+        self._device = torch.device("cpu", index)
+        self.model.to(self._device)
+
+        if use_ipex:
+            self._ipex_optimize()
 
     def to_fp16(self) -> None:
         """
-        Converts the model to a FP16 representation.
+        Generates using FP16 mixed precision: the weights are kept in FP32,
+        but operations which are safe in FP16 (e.g. matmuls) run in FP16.
         Should only be used to generate on a supported GPU.
         """
 
-        self.model = self.model.half()
+        self._autocast_dtype = torch.float16
+
+    def to_bf16(self) -> None:
+        """
+        Converts the model weights to BF16, which halves their memory usage
+        but keeps the same range as FP32, and generates in BF16.
+        Should only be used on GPUs which support it (Ampere or newer) or CPUs.
+
+        On CPU, if intel_extension_for_pytorch is installed, the model is
+        also optimized to use its BF16 kernels.
+        """
+
+        self.model = self.model.to(dtype=torch.bfloat16)
+        self._autocast_dtype = torch.bfloat16
+        self._num_params_m = None
+
+        if self.get_device() == "cpu":
+            self._ipex_optimize()
+
+    def _ipex_optimize(self) -> None:
+        """
+        Optimizes the model for inference on Intel CPUs, in BF16 if to_bf16()
+        has been called, if intel_extension_for_pytorch is installed.
+        """
+
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            return
+
+        bf16 = self._autocast_dtype == torch.bfloat16
+        self.model = ipex.optimize(
+            self.model.eval(),
+            dtype=torch.bfloat16 if bf16 else torch.float32,
+            inplace=True,
+        )
+
+    def to_int8_static(
+        self, calibration_texts: List[str], backend: str = "fbgemm"
+    ) -> None:
+        """
+        Quantizes the model's Linear layers, both their weights and their
+        inputs, to INT8 using static post-training quantization, so they run
+        as INT8 matrix multiplications on CPU. The scale of each layer's inputs
+        is calibrated by running the model over the given texts.
+
+        The quantized model can still generate, but can no longer be saved,
+        exported or trained, so save it beforehand if needed.
+
+        :param calibration_texts: Texts representative of the generation inputs
+        :param backend: Quantization engine: "fbgemm" for x86, "qnnpack" for ARM
+        """
+
+        assert (
+            self.get_device() == "cpu"
+        ), "Static INT8 quantization is only supported on CPU."
+
+        # count the parameters now, as the packed INT8 weights are not parameters
+        num_params = sum(p.numel() for p in self.model.parameters())
+        self._num_params_m = int(num_params / 10 ** 6)
+
+        torch.backends.quantized.engine = backend
+        qconfig = torch.quantization.get_default_qconfig(backend)
+
+        # quantize/dequantize around each Linear layer so the rest of the model,
+        # and generation with it, stays in floating point
+        conv1d_to_linear(self.model)
+        for module in list(self.model.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, torch.nn.Linear):
+                    wrapper = torch.quantization.QuantWrapper(child)
+                    wrapper.qconfig = qconfig
+                    setattr(module, name, wrapper)
+
+        self.model = self.model.eval()
+        torch.quantization.prepare(self.model, inplace=True)
+        with torch.no_grad():
+            for text in calibration_texts:
+                input_ids = self.tokenizer(text, return_tensors="pt").input_ids
+                self.model(input_ids[:, : self._max_length])
+        torch.quantization.convert(self.model, inplace=True)
+        self._quantized_static = True
+
+    def _autocast(self):
+        """Returns the autocast context for the mixed precision set, if any."""
+
+        return torch.autocast(
+            device_type=self.get_device(),
+            dtype=self._autocast_dtype,
+            enabled=self._autocast_dtype is not None,
+        )
+
+    def _compile_model(self, mode: str = "reduce-overhead") -> None:
+        """
+        Compiles the model's forward pass with torch.compile, fusing its kernels
+        and, in the default mode, capturing CUDA graphs to reduce the per-token
+        launch overhead of generation.
+        """
+
+        if not _TORCH_COMPILE:
+            logger.warning("Compiling the model requires PyTorch 2.1 or later.")
+            return
+
+        if "forward" in self.model.__dict__:
+            logger.info("The model is already compiled.")
+            return
+
+        # Cache compiled kernels on disk so later runs skip most of the work
+        os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "aitextgen", "compile"),
+        )
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+        # model.generate() calls forward() directly, so compile that
+        # rather than wrapping the model itself.
+        self.model.forward = torch.compile(self.model.forward, mode=mode, dynamic=True)
 
     def get_device(self) -> str:
         """Getter for the current device where the model is located."""
-        return self.model.device.type
+        return (self._device or self.model.device).type
 
     def __repr__(self) -> str:
-        # https://discuss.pytorch.org/t/how-do-i-check-the-number-of-parameters-of-a-model/4325/24
-        num_params_m = int(sum(p.numel() for p in self.model.parameters()) / 10 ** 6)
+        if self._num_params_m is None:
+            # https://discuss.pytorch.org/t/how-do-i-check-the-number-of-parameters-of-a-model/4325/24
+            num_params = sum(p.numel() for p in self.model.parameters())
+            self._num_params_m = int(num_params / 10 ** 6)
         model_name = type(self.model.config).__name__.replace("Config", "")
-        return f"{model_name} loaded with {num_params_m}M parameters."
+        return f"{model_name} loaded with {self._num_params_m}M parameters."
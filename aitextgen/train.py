@@ -38,12 +38,21 @@ class ATGTransformer(pl.LightningModule):
         return {"loss": loss}
 
     def train_dataloader(self):
+        # Keep workers alive across epochs, with batches queued ahead of the GPU
+        worker_kwargs = {}
+        if self.hparams["num_workers"] > 0:
+            worker_kwargs = dict(
+                persistent_workers=self.hparams["persistent_workers"],
+                prefetch_factor=self.hparams["prefetch_factor"],
+            )
+
         return DataLoader(
             self.dataset,
             batch_size=self.hparams["batch_size"],
             shuffle=True,
             pin_memory=self.hparams["pin_memory"],
             num_workers=self.hparams["num_workers"],
+            **worker_kwargs,
         )
 
     def configure_optimizers(self):
@@ -68,11 +77,22 @@ class ATGTransformer(pl.LightningModule):
                 "weight_decay": 0.0,
             },
         ]
-        optimizer = AdamW(
-            optimizer_grouped_parameters,
+        optimizer_kwargs = dict(
             lr=self.hparams["learning_rate"],
             eps=self.hparams["adam_epsilon"],
         )
+        if self.hparams["optimizer"] == "adamw_fused":
+            optimizer = AdamW(
+                optimizer_grouped_parameters, fused=True, **optimizer_kwargs
+            )
+        elif self.hparams["optimizer"] == "adamw_8bit":
+            import bitsandbytes as bnb
+
+            optimizer = bnb.optim.AdamW8bit(
+                optimizer_grouped_parameters, **optimizer_kwargs
+            )
+        else:
+            optimizer = AdamW(optimizer_grouped_parameters, **optimizer_kwargs)
 
         scheduler = get_linear_schedule_with_warmup(
             optimizer,
@@ -243,12 +263,19 @@ class ATGProgressBar(ProgressBarBase):
             )
         if tpu:
             import torch_xla.core.xla_model as xm
-            pl_module.model.save_pretrained(self.output_dir, save_function=xm.save)
+
+            # safetensors are written directly rather than through xm.save,
+            # so copy the weights off the TPU and save from one process only
+            state_dict = {k: v.cpu() for k, v in pl_module.model.state_dict().items()}
+            if xm.is_master_ordinal():
+                pl_module.model.save_pretrained(
+                    self.output_dir, state_dict=state_dict, safe_serialization=True
+                )
         else:
-            pl_module.model.save_pretrained(self.output_dir)
+            pl_module.model.save_pretrained(self.output_dir, safe_serialization=True)
 
         if self.enabled and self.save_gdrive:
-            for pt_file in ["pytorch_model.bin", "config.json"]:
+            for pt_file in ["model.safetensors", "config.json"]:
                 shutil.copyfile(
                     os.path.join(self.output_dir, pt_file),
                     os.path.join("/content/drive/My Drive/", self.run_id, pt_file),
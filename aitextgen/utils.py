@@ -177,6 +177,35 @@ def find_index_of_subset(large_list, small_list):
     return -1
 
 
+def find_indices_of_subsets(outputs, small_lists):
+    """
+    For each row of the 2D outputs tensor, returns the index after the first
+    occurrence of each of the small_lists within the row (or -1 if not present),
+    as a nested list of shape [batch, len(small_lists)].
+
+    The search is done with tensor ops on the outputs' device, so the only
+    device-to-host transfer is of the final indices.
+    """
+    batch_size, seq_len = outputs.shape
+    columns = []
+    for small_list in small_lists:
+        length = len(small_list)
+        if length > seq_len:
+            columns.append(
+                torch.full((batch_size,), -1, dtype=torch.long, device=outputs.device)
+            )
+            continue
+
+        small_tensor = torch.as_tensor(small_list, device=outputs.device)
+        matches = (outputs.unfold(1, length, 1) == small_tensor).all(-1)
+        window_starts = torch.arange(matches.shape[1], device=outputs.device)
+        window_starts = window_starts.expand_as(matches).masked_fill(~matches, seq_len)
+        first_starts = window_starts.min(1).values
+        columns.append((first_starts + length).masked_fill(first_starts == seq_len, -1))
+
+    return torch.stack(columns, dim=1).tolist()
+
+
 def skip_special_tokens(tensor, device, special_token_ids):
     """Filters out special tokens by ids in the given 1D tensor.
 
@@ -200,3 +229,25 @@ def model_max_length(config):
     return getattr(config, "n_positions", None) or getattr(
         config, "max_position_embeddings", None
     )
+
+
+def conv1d_to_linear(model):
+    """
+    Replaces the Conv1D layers used by GPT-2 (Linear layers with a transposed
+    weight) with equivalent torch.nn.Linear layers in place, so they can be
+    handled by PyTorch's quantization tools.
+    """
+    try:
+        from transformers.pytorch_utils import Conv1D
+    except ImportError:
+        from transformers.modeling_utils import Conv1D
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features, device="meta")
+                linear.weight = torch.nn.Parameter(child.weight.t().contiguous())
+                linear.bias = child.bias
+                setattr(module, name, linear)
+    return model
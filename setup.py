@@ -17,9 +17,10 @@ setup(
     python_requires=">=3.6",
     include_package_data=True,
     install_requires=[
-        "transformers>=4.5.1",
+        "transformers>=4.30.0",
+        "safetensors>=0.3.1",
         "fire>=0.3.0",
-        "pytorch-lightning>=1.3.1",
-        "torch>=1.6.0",
+        "pytorch-lightning>=1.5.0",
+        "torch>=1.10.0",
     ],
 )